@@ -4,41 +4,65 @@
 import os
 from dotenv import load_dotenv
 import asyncio
+import calendar
+import functools
 import logging
-import textwrap
+import re
+import threading
 import time
-from datetime import datetime, timezone
-from typing import Optional, Dict
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from html import escape
+from itertools import accumulate
+from typing import Callable, Optional, Dict, Iterable, Iterator, List, NamedTuple, Tuple
 
 import docker
-from docker.errors import NotFound
+from docker.errors import ImageNotFound, NotFound
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.constants import ParseMode
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
 )
+from telegram.request import HTTPXRequest
+
+try:
+    # optional: faster parsing of Bot API responses
+    import orjson
+except ImportError:
+    orjson = None
 
 load_dotenv()
 # ---------------------- Configuration ----------------------
-LOG_POLL_INTERVAL = float(os.getenv("LOG_POLL_INTERVAL", "1"))
 STREAM_RATE_LIMIT = float(os.getenv("STREAM_RATE_LIMIT", "2"))
-MAX_LINES_PER_MSG = int(os.getenv("MAX_LINES_PER_MSG", "10"))
+STREAM_BUFFER_LINES = int(os.getenv("STREAM_BUFFER_LINES", "500"))  # cap on lines held per stream while sends lag
+MAX_ACTIVE_STREAMS = int(os.getenv("MAX_ACTIVE_STREAMS", "32"))  # concurrent /stream sessions across all chats
 MAX_MESSAGE_CHUNK = 3900  # safety under Telegram 4096 chars
-
-from dotenv import dotenv_values
-env = dotenv_values()
-
-TELEGRAM_TOKEN = env.get("TELEGRAM_TOKEN")
-ALLOWED_USERS = set()
-if env.get("ALLOWED_USERS"):
-    ALLOWED_USERS = set(int(x.strip()) for x in env.get("ALLOWED_USERS").split(",") if x.strip())
+LOG_LINE_MAX_BYTES = 16 * 1024  # a TTY line with no newline yet is passed on in pieces of this size
+TELEGRAM_MAX_RETRIES = 3  # resend attempts after a 429 RetryAfter
+CONTAINER_CACHE_TTL = float(os.getenv("CONTAINER_CACHE_TTL", "2"))  # seconds a containers.list() result is reused
+EVENTS_RETRY_DELAY = 5.0  # seconds before reconnecting to the docker event stream
+STREAM_MAX_RECONNECTS = 3  # consecutive docker read errors a /stream reattaches after before giving up
+STREAM_RETRY_DELAY = 2.0  # seconds before a /stream reattaches to the container's logs
+DOCKER_MAX_POOL_SIZE = int(os.getenv("DOCKER_MAX_POOL_SIZE", "64"))
+DOCKER_WORKERS = int(os.getenv("DOCKER_WORKERS", "8"))  # threads for one-off docker API calls
+
+TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+ALLOWED_USERS: frozenset = frozenset(
+    int(x.strip()) for x in os.getenv("ALLOWED_USERS", "").split(",") if x.strip()
+)
 
 if not TELEGRAM_TOKEN:
     raise SystemExit("TELEGRAM_TOKEN environment variable is required")
+if not ALLOWED_USERS:
+    # an empty allow-list would deny every update; fail fast instead of running a bot nobody can use
+    raise SystemExit("ALLOWED_USERS environment variable is required")
 
 # ---------------------- Logging ----------------------
 logging.basicConfig(
@@ -48,101 +72,458 @@ logger = logging.getLogger("telegram-docker-monitor")
 
 # ---------------------- Docker client ----------------------
 try:
-    docker_client = docker.from_env()
+    # every live stream and the event watcher pin one pooled connection for as long as they run
+    docker_client = docker.from_env(max_pool_size=DOCKER_MAX_POOL_SIZE)
 except Exception as e:
     logger.exception("Failed to create Docker client: %s", e)
     raise
 
-# Active streams: chat_id -> {"task": asyncio.Task, "container": container_name_or_id}
-active_streams: Dict[int, Dict] = {}
+# One-off blocking docker calls (list/get/logs/reload) run here rather than in asyncio's default
+# executor, bounding concurrent daemon requests. Long-lived streams use their own _StreamReader threads.
+DOCKER_POOL = ThreadPoolExecutor(max_workers=DOCKER_WORKERS, thread_name_prefix="docker")
 
-# ---------------------- Helpers ----------------------
 
-def authorized(user_id: Optional[int]) -> bool:
-    if not ALLOWED_USERS:
-        # if ALLOWED_USERS is empty, be conservative and deny access
-        return False
-    return user_id in ALLOWED_USERS
+async def _docker_call(fn, *args, **kwargs):
+    """Run a blocking docker-py call on DOCKER_POOL."""
+    return await asyncio.get_running_loop().run_in_executor(DOCKER_POOL, functools.partial(fn, *args, **kwargs))
 
 
+# Active streams: chat_id -> {"task": asyncio.Task, "stop": threading.Event, "container": container_name_or_id}
+active_streams: Dict[int, Dict] = {}
+
+# ---------------------- Helpers ----------------------
+
 async def require_auth(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     user = update.effective_user
-    if user is None or not authorized(user.id):
+    # single frozenset lookup; ALLOWED_USERS is guaranteed non-empty at startup
+    if user is None or user.id not in ALLOWED_USERS:
         await update.effective_message.reply_text("❌ Access denied. You are not authorized to use this bot.")
         return False
     return True
 
 
+class _ContainerIndex(NamedTuple):
+    fetched_at: float
+    by_key: Dict[str, object]  # name_lower / short_id / id -> container
+    containers: List  # in containers.list() order
+    sorted_keys: List[str]  # sorted(by_key) for prefix lookups
+
+
+_EMPTY_INDEX = _ContainerIndex(float("-inf"), {}, [], [])
+# keyed by the containers.list(all=...) flag: True = every container, False = running only
+_container_index_cache: Dict[bool, _ContainerIndex] = {True: _EMPTY_INDEX, False: _EMPTY_INDEX}
+_container_index_lock = asyncio.Lock()
+
+
+def _index_is_fresh(index: _ContainerIndex) -> bool:
+    return time.monotonic() - index.fetched_at < CONTAINER_CACHE_TTL
+
+
+async def _get_container_index(force: bool = False, all_containers: bool = True) -> _ContainerIndex:
+    """Return the index built from one containers.list() call, reused for CONTAINER_CACHE_TTL seconds."""
+    cached = _container_index_cache[all_containers]
+    if not force and _index_is_fresh(cached):
+        return cached
+    async with _container_index_lock:
+        # another caller may have refreshed while we waited for the lock
+        cached = _container_index_cache[all_containers]
+        if not force and _index_is_fresh(cached):
+            return cached
+        containers = await _docker_call(docker_client.containers.list, all=all_containers)
+        by_key = {}
+        for c in containers:
+            _index_container(by_key, c)
+        index = _ContainerIndex(time.monotonic(), by_key, containers, sorted(by_key))
+        _container_index_cache[all_containers] = index
+        return index
+
+
+def _index_container(by_key: Dict[str, object], c):
+    by_key[c.name.lower()] = c
+    by_key[c.short_id] = c
+    by_key[c.id] = c
+
+
+def _invalidate_container_index():
+    """Force the next lookup to relist (containers were created, removed or renamed)."""
+    _container_index_cache[True] = _EMPTY_INDEX
+    _container_index_cache[False] = _EMPTY_INDEX
+
+
 async def find_container(identifier: str):
     """Try to find a container by id, name or partial match. Returns container object or raises NotFound."""
-    # Try exact get by id/name
-    try:
-        container = await asyncio.to_thread(docker_client.containers.get, identifier)
+    identifier_l = identifier.lower()
+
+    # Logs/streams almost always target running containers, and hosts can carry many exited ones.
+    # Unless the full listing is already cached, try an exact hit among running containers first.
+    if not _index_is_fresh(_container_index_cache[True]):
+        container = (await _get_container_index(all_containers=False)).by_key.get(identifier_l)
+        if container is not None:
+            return container
+
+    index = await _get_container_index()
+
+    # Exact name / id hit
+    container = index.by_key.get(identifier_l)
+    if container is not None:
         return container
-    except NotFound:
-        pass
+
+    # Name or id starting with identifier: binary search over the sorted keys
+    keys = index.sorted_keys
+    i = bisect_left(keys, identifier_l)
+    if i < len(keys) and keys[i].startswith(identifier_l):
+        return index.by_key[keys[i]]
 
     # Try partial match against names and ids
-    containers = await asyncio.to_thread(docker_client.containers.list, True)
-    identifier_l = identifier.lower()
-    for c in containers:
+    for c in index.containers:
         # c.name is primary name without leading '/'
         try:
-            if identifier_l == c.name.lower() or identifier_l in c.name.lower():
+            if identifier_l in c.name.lower():
                 return c
         except Exception:
             pass
         if identifier_l in c.short_id.lower() or identifier_l in c.id.lower():
             return c
+
+    # Not in the cached listing (e.g. created in the last few seconds): ask docker directly
+    try:
+        container = await _docker_call(docker_client.containers.get, identifier)
+    except NotFound:
+        pass
+    else:
+        # remember it for the rest of the TTL window so repeated presses skip the daemon
+        index.by_key[identifier_l] = container
+        _index_container(index.by_key, container)
+        return container
     # not found
     raise NotFound(f"No container matching '{identifier}'")
 
 
-def split_long_message(text: str, max_chunk: int = MAX_MESSAGE_CHUNK):
-    """Split long text into chunks under max_chunk while preserving lines."""
-    if len(text) <= max_chunk:
-        return [text]
-    lines = text.splitlines()
-    chunks = []
-    cur = []
-    cur_len = 0
-    for ln in lines:
-        lnlen = len(ln) + 1
-        if cur_len + lnlen > max_chunk and cur:
-            chunks.append("\n".join(cur))
-            cur = []
-            cur_len = 0
-        cur.append(ln)
-        cur_len += lnlen
-    if cur:
-        chunks.append("\n".join(cur))
-    return chunks
+def _utf16_len(text: str) -> int:
+    """Length as Telegram counts it (UTF-16 code units)."""
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _wrap_line(line: str, width: int) -> List[str]:
+    """Cut a line into pieces of at most width UTF-16 code units.
+
+    A cut never falls inside a surrogate pair or an escaped HTML entity such as &amp;.
+    """
+    if _utf16_len(line) <= width:
+        return [line]
+    data = line.encode("utf-16-le")
+    pieces = []
+    start = 0
+    while start < len(data):
+        end = min(start + 2 * width, len(data))
+        if end < len(data) and 0xD8 <= data[end - 1] <= 0xDB:
+            # the last unit is a high surrogate; keep the pair together in the next piece
+            end -= 2
+        piece = data[start:end].decode("utf-16-le")
+        if end < len(data):
+            # entities are at most 5 units long (&amp;); an unterminated one moves to the next piece
+            amp = piece.rfind("&", len(piece) - 4)
+            if amp > 0 and ";" not in piece[amp:]:
+                end -= 2 * (len(piece) - amp)
+                piece = piece[:amp]
+        pieces.append(piece)
+        start = end
+    return pieces
+
+
+def split_long_message(text: str, max_chunk: int = MAX_MESSAGE_CHUNK) -> Iterator[str]:
+    """Yield chunks of text under max_chunk (UTF-16 code units), breaking at newlines where possible.
+
+    Lines longer than max_chunk are hard-wrapped.
+    """
+    if _utf16_len(text) <= max_chunk:
+        # common case: fits in one message, no line scan needed
+        yield text
+        return
+    lines = [piece for ln in text.splitlines() for piece in _wrap_line(ln, max_chunk)]
+    # cum[i] = size of lines[0..i] including one newline after each
+    cum = list(accumulate(_utf16_len(ln) + 1 for ln in lines))
+    start = 0
+    offset = 0
+    while start < len(lines):
+        # the last line of a chunk carries no newline, hence the +1
+        end = bisect_right(cum, offset + max_chunk + 1, lo=start)
+        yield "\n".join(lines[start:end])
+        offset = cum[end - 1]
+        start = end
+
+
+class _StreamReader(threading.Thread):
+    """Daemon thread that drains a blocking docker stream (logs, events) into an asyncio.Queue.
+
+    A ``None`` item marks the end of the stream; an exception instance is pushed if reading fails.
+    With max_pending, items arriving while that many are already queued are dropped and counted
+    in ``dropped`` (the end and error markers are always delivered). iter_items turns the raw
+    stream into the items to queue; the raw stream is what stop() closes.
+    """
+
+    def __init__(self, open_stream: Callable, name: str, loop: asyncio.AbstractEventLoop,
+                 stop_event: Optional[threading.Event] = None, max_pending: int = 0,
+                 iter_items: Callable[[Iterable], Iterable] = iter):
+        super().__init__(name=name, daemon=True)
+        self.open_stream = open_stream
+        self.iter_items = iter_items
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.max_pending = max_pending
+        self.dropped = 0  # only touched on the event loop
+        self.stop_event = stop_event or threading.Event()
+        self.stream = None
+
+    def _enqueue(self, item):
+        # runs on the event loop
+        if (self.max_pending and self.queue.qsize() >= self.max_pending
+                and item is not None and not isinstance(item, Exception)):
+            self.dropped += 1
+            return
+        self.queue.put_nowait(item)
+
+    def _push(self, item):
+        try:
+            self.loop.call_soon_threadsafe(self._enqueue, item)
+        except RuntimeError:
+            # event loop already closed (bot shutting down)
+            self.stop_event.set()
+
+    def run(self):
+        try:
+            self.stream = self.open_stream()
+            if self.stop_event.is_set():
+                self.stream.close()
+            for item in self.iter_items(self.stream):
+                if self.stop_event.is_set():
+                    break
+                self._push(item)
+        except Exception as e:
+            if not self.stop_event.is_set():
+                self._push(e)
+        finally:
+            self._push(None)
+
+    def stop(self):
+        """Ask the thread to exit and close the underlying HTTP response so a blocked read returns."""
+        self.stop_event.set()
+        if self.stream is not None:
+            try:
+                self.stream.close()
+            except Exception:
+                pass
+
+
+# the fixed-width RFC3339Nano UTC prefix docker puts on every line with timestamps=True
+_LOG_TIMESTAMP = re.compile(r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{9}Z")
+
+
+def _log_timestamp_since(ts: str) -> float:
+    """Epoch seconds of a docker log timestamp (2025-01-01T00:00:00.123456789Z), cut to microseconds.
+
+    Truncating keeps the result at or before ts, so `since` never skips a line written after it.
+    """
+    seconds = calendar.timegm(time.strptime(ts[:19], "%Y-%m-%dT%H:%M:%S"))
+    return float(f"{seconds}.{ts[20:26]}")
+
+
+def _iter_log_frames(frames: Iterable[bytes]) -> Iterator[bytes]:
+    """Lines of a non-TTY container's log stream, without the line ending.
+
+    docker-py yields one demultiplexed frame per log entry: a whole line, or a 16 KB part of a
+    longer one, which carries its own timestamp and is passed on as a line of its own.
+    """
+    for frame in frames:
+        for ln in frame.removesuffix(b"\n").split(b"\n"):
+            yield ln.removesuffix(b"\r")
+
+
+def _iter_tty_lines(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Re-split a TTY container's raw log output into lines, without the line ending.
+
+    TTY output arrives a byte at a time, so a line (or a multi-byte character) can span many items.
+    A line is yielded once its newline arrives, or in LOG_LINE_MAX_BYTES pieces if none comes
+    (e.g. a progress bar redrawn with \r).
+    """
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        if b"\n" in chunk:
+            *lines, rest = pending.split(b"\n")
+            pending = rest
+            for ln in lines:
+                yield bytes(ln.removesuffix(b"\r"))
+        while len(pending) > LOG_LINE_MAX_BYTES:
+            cut = LOG_LINE_MAX_BYTES
+            # don't split a multi-byte character: back up to its first byte
+            while cut > 0 and pending[cut] & 0xC0 == 0x80:
+                cut -= 1
+            cut = cut or LOG_LINE_MAX_BYTES
+            yield bytes(pending[:cut])
+            del pending[:cut]
+    if pending:
+        yield bytes(pending.removesuffix(b"\r"))
+
+
+def _spawn_log_reader(container, stop_event: Optional[threading.Event] = None,
+                      since: Optional[float] = None) -> _StreamReader:
+    """Start a persistent `logs(follow=True)` reader for container; lines arrive on reader.queue as bytes.
+
+    Setting stop_event makes the thread exit at the next line instead of draining the stream.
+    With since (epoch seconds) the stream starts there instead of at the current end of the log.
+    """
+    # tail=0: only lines written from now on. For non-TTY containers docker-py already
+    # demultiplexes the stdout/stderr frames, so each item is a clean payload without headers;
+    # TTY output comes as raw bytes and has to be reassembled into lines.
+    # docker-py passes a float `since` through and the daemon honours the fraction
+    kwargs = {"tail": 0} if since is None else {"since": since}
+
+    def open_stream():
+        return container.logs(stream=True, follow=True, timestamps=True, stdout=True, stderr=True, **kwargs)
+
+    tty = container.attrs.get("Config", {}).get("Tty", False)
+    # lines queued beyond the stream buffer's size would only be evicted from it again
+    reader = _StreamReader(open_stream, f"log-reader-{container.short_id}", asyncio.get_running_loop(),
+                           stop_event, max_pending=STREAM_BUFFER_LINES,
+                           iter_items=_iter_tty_lines if tty else _iter_log_frames)
+    reader.start()
+    return reader
+
+
+# ---------------------- Container events ----------------------
+
+@dataclass(slots=True)
+class ContainerState:
+    name: str
+    status: str
+
+
+# id -> ContainerState, seeded from containers.list() and kept current by watch_events()
+CONTAINERS: Dict[str, ContainerState] = {}
+_events_live = False
+
+# docker event action -> container status it leaves behind
+_EVENT_STATUS = {
+    "create": "created",
+    "start": "running",
+    "restart": "running",
+    "unpause": "running",
+    "pause": "paused",
+    "die": "exited",
+    "stop": "exited",
+}
+
+
+def _apply_event(event: dict):
+    """Fold one docker container event into CONTAINERS."""
+    action = event.get("Action") or event.get("status")
+    actor = event.get("Actor") or {}
+    cid = actor.get("ID") or event.get("id")
+    name = (actor.get("Attributes") or {}).get("name")
+    if not cid:
+        return
+
+    if action == "destroy":
+        CONTAINERS.pop(cid, None)
+    elif action == "rename" or action in _EVENT_STATUS:
+        state = CONTAINERS.get(cid)
+        if state is None:
+            state = CONTAINERS[cid] = ContainerState(name or cid[:12], "created")
+        if name:
+            state.name = name
+        if action in _EVENT_STATUS:
+            state.status = _EVENT_STATUS[action]
+    else:
+        # exec_*, attach, health_status, ... do not change what /container shows
+        return
+
+    if action in ("create", "destroy", "rename"):
+        _invalidate_container_index()
+
+
+async def watch_events():
+    """Keep CONTAINERS in sync with the docker events stream, reconnecting if the daemon goes away."""
+    global _events_live
+    loop = asyncio.get_running_loop()
+    while True:
+        reader = None
+        try:
+            since = int(time.time())
+            containers = (await _get_container_index(force=True)).containers
+            CONTAINERS.clear()
+            CONTAINERS.update((c.id, ContainerState(c.name, c.status)) for c in containers)
+
+            # replay from just before the seed listing so nothing in between is missed
+            reader = _StreamReader(
+                lambda: docker_client.events(since=since, decode=True, filters={"type": "container"}),
+                "docker-events",
+                loop,
+            )
+            reader.start()
+            _events_live = True
+            while True:
+                item = await reader.queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                _apply_event(item)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Docker event stream error: %s", e)
+        finally:
+            _events_live = False
+            if reader is not None:
+                reader.stop()
+        logger.info("Docker event stream closed; reconnecting in %ss", EVENTS_RETRY_DELAY)
+        await asyncio.sleep(EVENTS_RETRY_DELAY)
 
 
 # ---------------------- Shared Helpers ----------------------
 
 async def show_logs(chat_id: int, container, bot):
     """Send last 50 lines of logs from a container."""
-    raw = await asyncio.to_thread(container.logs, tail=50, stdout=True, stderr=True)
+    # stdout and stderr come back interleaved in write order; docker-py removes the frame headers
+    raw = await _docker_call(container.logs, tail=50, stdout=True, stderr=True)
     if not raw:
         await bot.send_message(chat_id, "(No logs yet)")
         return
-    text = raw.decode(errors="replace")
+    # escape once up front: chunking breaks at newlines and hard wraps never cut an entity
+    text = escape(raw.decode(errors="replace"), quote=False)
     for chunk in split_long_message(text):
         await bot.send_message(chat_id, f"<pre>{chunk}</pre>", parse_mode=ParseMode.HTML)
 
 
-async def show_status(chat_id: int, container, bot):
-    """Send detailed status of a container."""
-    await asyncio.to_thread(container.reload)
-    info = (
+def _reload_with_image_tag(container) -> str:
+    """Blocking: refresh container and return its image's first tag ('untagged' if none or removed)."""
+    container.reload()
+    try:
+        # container.image is another daemon request (images.get)
+        image = container.image
+    except ImageNotFound:
+        return "untagged"
+    return image.tags[0] if image is not None and image.tags else "untagged"
+
+
+async def _render_status(container) -> str:
+    """Refresh a container and format its details as an HTML message."""
+    image_tag = await _docker_call(_reload_with_image_tag, container)
+    return (
         f"<b>{container.name}</b>\n"
         f"ID: {container.id[:12]}\n"
-        f"Image: {container.image.tags[0] if container.image.tags else 'untagged'}\n"
+        f"Image: {image_tag}\n"
         f"Created: {container.attrs['Created']}\n"
         f"Status: {container.status}"
     )
-    await bot.send_message(chat_id, info, parse_mode=ParseMode.HTML)
+
+
+async def show_status(chat_id: int, container, bot):
+    """Send detailed status of a container."""
+    await bot.send_message(chat_id, await _render_status(container), parse_mode=ParseMode.HTML)
 
 
 async def start_stream(chat_id: int, container, bot):
@@ -150,133 +531,243 @@ async def start_stream(chat_id: int, container, bot):
     if chat_id in active_streams:
         await bot.send_message(chat_id, "⚠️ Stream already running. Use /stop first.")
         return
+    if len(active_streams) >= MAX_ACTIVE_STREAMS:
+        # each stream holds a reader thread and a pooled docker connection
+        await bot.send_message(chat_id, "⚠️ Too many active streams right now. Try again later.")
+        return
 
-    async def stream_task():
-        try:
-            for line in container.logs(stream=True, follow=True, timestamps=True):
-                if chat_id not in active_streams:
-                    break
-                text = line.decode(errors="replace").strip()
-                if text:
-                    await bot.send_message(chat_id, f"<pre>{text}</pre>", parse_mode=ParseMode.HTML)
-                await asyncio.sleep(1)  # rate limit
-        except Exception as e:
-            logger.error(f"Stream error: {e}")
-            await bot.send_message(chat_id, f"❌ Stream error: {e}")
-
-    task = asyncio.create_task(stream_task())
-    active_streams[chat_id] = {"task": task, "container": container.name}
+    stop_event = threading.Event()
+    task = asyncio.create_task(_start_stream_for_chat(chat_id, container, bot, stop_event))
+    active_streams[chat_id] = {"task": task, "stop": stop_event, "container": container.name}
     await bot.send_message(chat_id, f"▶️ Started streaming logs for <b>{container.name}</b>", parse_mode=ParseMode.HTML)
 
 # ---------------------- Command Handlers ----------------------
 
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+@functools.lru_cache(maxsize=512)
+def _keyboard_for(name: str) -> InlineKeyboardMarkup:
+    """Logs/Stream/Status buttons for a container. PTB markup objects are immutable, so one per name is reused."""
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("Logs", callback_data=f"logs:{name}"),
+            InlineKeyboardButton("Stream", callback_data=f"stream:{name}"),
+            InlineKeyboardButton("Status", callback_data=f"status:{name}"),
+        ]
+    ])
+
+
+@functools.lru_cache(maxsize=1024)
+def _render_container_row(name: str, status: str) -> Tuple[str, InlineKeyboardMarkup]:
+    """(text, keyboard) for one container; memoized since only status transitions change it."""
+    # Add emoji: 🟢 running, 🔴 stopped/other
+    if status == "running":
+        emoji = "🟢"
+    else:
+        emoji = "🔴"
+    return f"{emoji} <b>{name}</b> - {status}", _keyboard_for(name)
+
+
+def _render_container_rows(records: List[ContainerState]) -> List[Tuple[str, InlineKeyboardMarkup]]:
+    """Format one (text, keyboard) message per container. Pure and synchronous: no docker access."""
+    return [_render_container_row(rec.name, rec.status) for rec in records]
+
 
 async def cmd_container(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await require_auth(update, context):
         return
 
     chat_id = update.effective_chat.id
-    containers = await asyncio.to_thread(docker_client.containers.list, all=True)
+    if _events_live:
+        # snapshot maintained from docker events: no daemon round-trip
+        records = list(CONTAINERS.values())
+    else:
+        # containers.list() already carries each container's state, so no per-container inspect is needed.
+        # Read the SDK's attrs-backed properties once per container.
+        containers = (await _get_container_index()).containers
+        records = [ContainerState(c.name, c.status) for c in containers]
 
-    if not containers:
+    if not records:
         await context.bot.send_message(chat_id, "No containers found.")
         return
 
-    for container in containers:
-        await asyncio.to_thread(container.reload)
-
-        # Add emoji: 🟢 running, 🔴 stopped/other
-        status = container.status
-        if status == "running":
-            emoji = "🟢"
-        else:
-            emoji = "🔴"
-
-        text = f"{emoji} <b>{container.name}</b> - {status}"
-
-        keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("Logs", callback_data=f"logs:{container.name}"),
-                InlineKeyboardButton("Stream", callback_data=f"stream:{container.name}"),
-                InlineKeyboardButton("Status", callback_data=f"status:{container.name}"),
-            ]
-        ])
-
+    for text, keyboard in _render_container_rows(records):
         await context.bot.send_message(chat_id, text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
 
 
-async def cmd_logs(update: Update, context: ContextTypes.DEFAULT_TYPE, identifier: str = None):
-    if not await require_auth(update, context):
-        return
+async def _container_from_args(update: Update, context: ContextTypes.DEFAULT_TYPE, identifier: Optional[str], command: str):
+    """Resolve the container named by a command's arguments, replying with usage / not-found. Returns None on failure."""
     chat_id = update.effective_chat.id
     identifier = identifier or " ".join(context.args)
     if not identifier:
-        await context.bot.send_message(chat_id, "Usage: /logs <container>")
-        return
-    container = await find_container(identifier)
-    if not container:
+        await context.bot.send_message(chat_id, f"Usage: /{command} <container>")
+        return None
+    try:
+        return await find_container(identifier)
+    except NotFound:
         await context.bot.send_message(chat_id, f"❌ No such container: {identifier}")
-        return
-    await show_logs(chat_id, container, context.bot)
+        return None
 
 
-async def _start_stream_for_chat(chat_id: int, container, context: ContextTypes.DEFAULT_TYPE):
-    """Start a polling-based stream for that chat and container. Safe to run inside container."""
-    bot = context.bot
-    await bot.send_message(chat_id, f"📡 Starting stream for <b>{getattr(container, 'name', container.id[:12])}</b>", parse_mode=ParseMode.HTML)
+async def cmd_logs(update: Update, context: ContextTypes.DEFAULT_TYPE, identifier: str = None):
+    if not await require_auth(update, context):
+        return
+    container = await _container_from_args(update, context, identifier, "logs")
+    if container is not None:
+        await show_logs(update.effective_chat.id, container, context.bot)
+
+
+async def _start_stream_for_chat(chat_id: int, container, bot, stop_event: threading.Event):
+    """Follow a container's logs for that chat, batching lines into messages. Safe to run inside container.
+
+    Lines are flushed every STREAM_RATE_LIMIT seconds, or early once they fill a whole message
+    (MAX_MESSAGE_CHUNK characters), so bursts are packed into as few sends as possible.
+    At most STREAM_BUFFER_LINES are held (and as many queued by the reader) while sends are slow;
+    lines beyond that are dropped with a notice.
+    If reading fails, the stream reattaches from the last line's timestamp (up to STREAM_MAX_RECONNECTS
+    times in a row) and skips lines already received, so nothing is sent twice.
+    """
+    # if the stream fails before its first line, it resumes from here (the daemon shares our clock)
+    started = time.time()
+    reader = _spawn_log_reader(container, stop_event)
+    loop = asyncio.get_running_loop()
+    # (line, size incl. newline) pairs; sizes are counted once, when the line arrives
+    buffer: deque = deque(maxlen=STREAM_BUFFER_LINES)
+    dropped = 0
+    buffered_chars = 0
+    last_sent = loop.time()
+    # docker writes fixed-width RFC3339Nano UTC timestamps, so they order correctly as strings
+    last_ts: Optional[str] = None
+    resume_after: Optional[str] = None
+    reconnects = 0
+
+    async def flush(everything: bool = True):
+        """Pack buffered lines into messages of up to MAX_MESSAGE_CHUNK; unless everything, keep a partial tail."""
+        nonlocal dropped, buffered_chars
+        while buffer and (everything or buffered_chars >= MAX_MESSAGE_CHUNK):
+            parts = []
+            size = 0
+            if dropped:
+                parts.append(f"… {dropped} lines dropped …")
+                size = len(parts[0]) + 1
+                dropped = 0
+            # the last line carries no newline, hence the +1
+            while buffer and (not parts or size + buffer[0][1] <= MAX_MESSAGE_CHUNK + 1):
+                ln, n = buffer.popleft()
+                parts.append(ln)
+                size += n
+                buffered_chars -= n
+            text = escape("\n".join(parts), quote=False)
+            await bot.send_message(chat_id, f"<pre>{text}</pre>", parse_mode=ParseMode.HTML)
 
-    last_ts = int(time.time())
-    buffer = []
-    last_sent = 0
     try:
         while True:
+            timeout = max(0.0, STREAM_RATE_LIMIT - (loop.time() - last_sent))
             try:
-                # fetch logs since last_ts (adds timestamps if available)
-                raw = await asyncio.to_thread(container.logs, since=last_ts, stdout=True, stderr=True, timestamps=True)
-            except Exception as e:
-                await bot.send_message(chat_id, f"Error reading logs: {e}")
+                items = [await asyncio.wait_for(reader.queue.get(), timeout=timeout)]
+            except asyncio.TimeoutError:
+                items = []
+            # take everything else the reader queued while we were sending
+            while not reader.queue.empty():
+                items.append(reader.queue.get_nowait())
+            if reader.dropped:
+                # the reader's queue overflowed while a send was in flight
+                dropped += reader.dropped
+                reader.dropped = 0
+
+            if stop_event.is_set():
+                break
+            ended = False
+            failure = None
+            raw_lines = []
+            for item in items:
+                if item is None:
+                    ended = True
+                    break
+                if isinstance(item, Exception):
+                    failure = item
+                    break
+                raw_lines.append(item)
+
+            # decode the whole batch at once; the reader's lines hold no b"\n", so splitting restores them
+            lines = b"\n".join(raw_lines).decode(errors="replace").split("\n") if raw_lines else []
+            for ln in lines:
+                # each line is prefixed with a timestamp from docker
+                ts = ln.partition(" ")[0]
+                has_ts = _LOG_TIMESTAMP.fullmatch(ts) is not None
+                if resume_after is not None:
+                    if not has_ts or ts <= resume_after:
+                        continue  # already received before the reconnect
+                    resume_after = None
+                if has_ts:
+                    last_ts = ts
+                reconnects = 0
+                n = _utf16_len(ln) + 1
+                # a line longer than a whole message (docker passes up to 16 KB) is hard-wrapped
+                pieces = [(ln, n)] if n <= MAX_MESSAGE_CHUNK + 1 else [
+                    (p, _utf16_len(p) + 1) for p in _wrap_line(ln, MAX_MESSAGE_CHUNK)]
+                for piece in pieces:
+                    if len(buffer) == STREAM_BUFFER_LINES:
+                        dropped += 1
+                        buffered_chars -= buffer[0][1]
+                    buffer.append(piece)
+                    buffered_chars += piece[1]
+
+            if failure is not None:
+                if reconnects >= STREAM_MAX_RECONNECTS:
+                    raise failure
+                reconnects += 1
+                logger.warning("Log stream for %s failed (%s); reconnecting (%d/%d)",
+                               container.name, failure, reconnects, STREAM_MAX_RECONNECTS)
+                # the failed reader thread has already exited; release its connection. reader.stop()
+                # would also set stop_event, which the next reader shares
+                if reader.stream is not None:
+                    try:
+                        reader.stream.close()
+                    except Exception:
+                        pass
+                await asyncio.sleep(STREAM_RETRY_DELAY)
+                # attach a fresh reader where the last one left off
+                since = _log_timestamp_since(last_ts) if last_ts is not None else started
+                reader = _spawn_log_reader(container, stop_event, since=since)
+                resume_after = last_ts
+                continue
+
+            if ended:
+                # docker closed the stream (container stopped/removed)
+                if buffer:
+                    await flush()
+                await bot.send_message(chat_id, "⏹ Log stream ended.")
                 break
 
-            last_ts = int(time.time())
-            if raw:
-                decoded = raw.decode(errors="replace").strip()
-                if decoded:
-                    # each line already may contain a timestamp from docker
-                    for ln in decoded.splitlines():
-                        buffer.append(ln)
-
-            if buffer and (len(buffer) >= MAX_LINES_PER_MSG or (time.time() - last_sent) >= STREAM_RATE_LIMIT):
-                payload = "\n".join(buffer)
-                chunks = split_long_message(payload)
-                for chunk in chunks:
-                    await bot.send_message(chat_id, f"<pre>{chunk}</pre>", parse_mode=ParseMode.HTML)
-                buffer = []
-                last_sent = time.time()
-
-            await asyncio.sleep(LOG_POLL_INTERVAL)
+            if buffer and (loop.time() - last_sent) >= STREAM_RATE_LIMIT:
+                await flush()
+                last_sent = loop.time()
+            elif buffered_chars >= MAX_MESSAGE_CHUNK:
+                # only whole messages go out early; the remainder waits for the next tick
+                await flush(everything=False)
+                last_sent = loop.time()
+            elif not buffer:
+                last_sent = loop.time()
     except asyncio.CancelledError:
-        # streaming was stopped by user
-        await bot.send_message(chat_id, "🛑 Stream stopped.")
+        # streaming was stopped by user; shield so the notice still goes out if cancelled again
+        await asyncio.shield(bot.send_message(chat_id, "🛑 Stream stopped."))
         raise
     except Exception as e:
         logger.exception("Stream error: %s", e)
         await bot.send_message(chat_id, f"Stream terminated due to error: {e}")
+    finally:
+        reader.stop()
+        # free the slot however the stream ended, unless a newer stream already took it
+        entry = active_streams.get(chat_id)
+        if entry is not None and entry.get("task") is asyncio.current_task():
+            active_streams.pop(chat_id, None)
 
 
 async def cmd_stream(update: Update, context: ContextTypes.DEFAULT_TYPE, identifier: str = None):
     if not await require_auth(update, context):
         return
-    chat_id = update.effective_chat.id
-    identifier = identifier or " ".join(context.args)
-    if not identifier:
-        await context.bot.send_message(chat_id, "Usage: /stream <container>")
-        return
-    container = await find_container(identifier)
-    if not container:
-        await context.bot.send_message(chat_id, f"❌ No such container: {identifier}")
-        return
-    await start_stream(chat_id, container, context.bot)
+    container = await _container_from_args(update, context, identifier, "stream")
+    if container is not None:
+        await start_stream(update.effective_chat.id, container, context.bot)
 
 
 async def cmd_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -287,32 +778,37 @@ async def cmd_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not existing:
         await context.bot.send_message(chat.id, "No active stream for this chat.")
         return
+    stop_event = existing.get("stop")
+    if stop_event:
+        stop_event.set()
     task = existing.get("task")
     if task and not task.done():
         task.cancel()
         await context.bot.send_message(chat.id, "Requested to stop the active stream...")
-        # optionally wait a moment
-        await asyncio.sleep(0.2)
+        # return as soon as the task has finished unwinding (it may still be sending its last batch);
+        # the task removes its own active_streams entry on the way out
+        await asyncio.wait({task}, timeout=2.0)
     active_streams.pop(chat.id, None)
 
 
 async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE, identifier: str = None):
     if not await require_auth(update, context):
         return
-    chat_id = update.effective_chat.id
-    identifier = identifier or " ".join(context.args)
-    if not identifier:
-        await context.bot.send_message(chat_id, "Usage: /status <container>")
-        return
-    container = await find_container(identifier)
-    if not container:
-        await context.bot.send_message(chat_id, f"❌ No such container: {identifier}")
-        return
-    await show_status(chat_id, container, context.bot)
+    container = await _container_from_args(update, context, identifier, "status")
+    if container is not None:
+        await show_status(update.effective_chat.id, container, context.bot)
 
 
 # ---------------------- Callback Query Handler ----------------------
 
+# callback_data action prefix -> shared helper taking (chat_id, container, bot)
+CALLBACK_HANDLERS = {
+    "logs": show_logs,
+    "stream": start_stream,
+    "status": show_status,
+}
+
+
 async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles button presses from inline keyboards."""
     query = update.callback_query
@@ -321,30 +817,87 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
     if not await require_auth(update, context):
         return
 
-    try:
-        action, identifier = query.data.split(":", 1)
-    except ValueError:
+    # callback_data is "<action>:<container name>"
+    action, sep, identifier = (query.data or "").partition(":")
+    if not sep or not identifier:
         await query.edit_message_text("❌ Invalid action.")
         return
 
-    if action == "logs":
-        await show_logs(query.message.chat_id, await find_container(identifier), context.bot)
-    elif action == "stream":
-        await start_stream(query.message.chat_id, await find_container(identifier), context.bot)
-    elif action == "status":
-        await show_status(query.message.chat_id, await find_container(identifier), context.bot)
-    else:
+    handler = CALLBACK_HANDLERS.get(action)
+    if handler is None:
         await query.edit_message_text("❌ Unknown action.")
+        return
+    # find_container resolves known names from the cached index without a daemon call
+    try:
+        container = await find_container(identifier)
+    except NotFound:
+        await query.edit_message_text(f"❌ No such container: {identifier}")
+        return
+    await handler(query.message.chat_id, container, context.bot)
 
 
 # ---------------------- Startup ----------------------
+class _OrjsonRequest(HTTPXRequest):
+    """HTTPXRequest that parses Bot API responses with orjson."""
+
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # let PTB decode leniently and raise/log its usual error
+            return HTTPXRequest.parse_json_payload(payload)
+
+
+_events_task: Optional[asyncio.Task] = None
+
 
 async def on_startup(app):
-    logger.info("Bot started; authorized users: %s", ",".join(str(x) for x in ALLOWED_USERS))
+    global _events_task
+    _events_task = asyncio.create_task(watch_events())
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Bot started; authorized users: %s", ",".join(str(x) for x in ALLOWED_USERS))
+
+
+async def on_stop(app):
+    """Cancel every live stream while the bot can still send the 'stopped' notices."""
+    entries = list(active_streams.values())
+    for entry in entries:
+        entry["stop"].set()
+        entry["task"].cancel()
+    await asyncio.gather(*(entry["task"] for entry in entries), return_exceptions=True)
+    active_streams.clear()
+
+
+async def on_shutdown(app):
+    if _events_task is not None:
+        _events_task.cancel()
+        await asyncio.gather(_events_task, return_exceptions=True)
+    DOCKER_POOL.shutdown(wait=False, cancel_futures=True)
 
 
 def main():
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    try:
+        # optional: faster event loop for many concurrent streams (Linux/macOS only)
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
+    # PTB queues and throttles every Bot API call (30 msg/s overall, 20 msg/min per group)
+    # and, on a 429, waits out retry_after before resending
+    rate_limiter = AIORateLimiter(
+        overall_max_rate=30,
+        overall_time_period=1,
+        group_max_rate=20,
+        group_time_period=60,
+        max_retries=TELEGRAM_MAX_RETRIES,
+    )
+    builder = ApplicationBuilder().token(TELEGRAM_TOKEN).rate_limiter(rate_limiter)
+    if orjson is not None:
+        # same pool sizes ApplicationBuilder picks for its default requests
+        builder = builder.request(_OrjsonRequest(connection_pool_size=256)).get_updates_request(_OrjsonRequest())
+    app = builder.build()
 
     app.add_handler(CommandHandler("container", cmd_container))
     app.add_handler(CommandHandler("logs", cmd_logs))
@@ -354,6 +907,8 @@ def main():
     app.add_handler(CallbackQueryHandler(callback_query_handler))
 
     app.post_init = on_startup
+    app.post_stop = on_stop
+    app.post_shutdown = on_shutdown
 
     logger.info("Starting Telegram Docker Monitor bot...")
     app.run_polling(allowed_updates=None)